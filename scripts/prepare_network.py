@@ -44,6 +44,7 @@ Outputs
 -------
 
 - ``networks/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}.nc``: Complete PyPSA network that will be handed to the ``solve_network`` rule.
+- ``networks/elec_s{simpl}_{clusters}_ec_l{ll}_{opts}_pnl/``: Time series of all components as Parquet files (one per component attribute), only written if ``enable: export_parquet`` is set.
 
 Description
 -----------
@@ -58,7 +59,9 @@ Description
 import logging
 from _helpers import configure_logging
 
+import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 import pypsa
 import numpy as np
 import pandas as pd
@@ -67,6 +70,10 @@ from add_electricity import load_costs, update_transmission_costs
 
 idx = pd.IndexSlice
 
+FLOAT_RE = re.compile(r"[0-9]*\.?[0-9]+$")
+HOURS_RE = re.compile(r"^\d+h$", re.IGNORECASE)
+SEGMENTS_RE = re.compile(r"^\d+seg$", re.IGNORECASE)
+
 logger = logging.getLogger(__name__)
 
 
@@ -79,12 +86,15 @@ def add_co2limit(n, co2limit, Nyears=1.):
 
 def add_emission_prices(n, emission_prices={'co2': 0.}, exclude_co2=False):
     if exclude_co2: emission_prices.pop('co2')
-    ep = (pd.Series(emission_prices).rename(lambda x: x+'_emissions') *
-          n.carriers.filter(like='_emissions')).sum(axis=1)
-    gen_ep = n.generators.carrier.map(ep) / n.generators.efficiency
-    n.generators['marginal_cost'] += gen_ep
-    su_ep = n.storage_units.carrier.map(ep) / n.storage_units.efficiency_dispatch
-    n.storage_units['marginal_cost'] += su_ep
+    em_cols = [c for c in n.carriers.columns if c.endswith('_emissions')]
+    prices = np.array([emission_prices.get(c[:-len('_emissions')], 0.) for c in em_cols])
+    ep = pd.Series(np.nan_to_num(n.carriers[em_cols].values.astype(float)) @ prices,
+                   index=n.carriers.index)
+    # both operands share the component index, so skip the alignment
+    gen_ep = n.generators.carrier.map(ep).values / n.generators.efficiency.values
+    n.generators['marginal_cost'] = n.generators.marginal_cost.values + gen_ep
+    su_ep = n.storage_units.carrier.map(ep).values / n.storage_units.efficiency_dispatch.values
+    n.storage_units['marginal_cost'] = n.storage_units.marginal_cost.values + su_ep
 
 
 def set_line_s_max_pu(n, s_max_pu = 0.7):
@@ -95,23 +105,32 @@ def set_line_s_max_pu(n, s_max_pu = 0.7):
 def set_transmission_limit(n, ll_type, factor, costs, Nyears=1):
     links_dc_b = n.links.carrier == 'DC' if not n.links.empty else pd.Series()
 
-    _lines_s_nom = (np.sqrt(3) * n.lines.type.map(n.line_types.i_nom) *
-                   n.lines.num_parallel *  n.lines.bus0.map(n.buses.v_nom))
+    i_nom = n.line_types.i_nom.reindex(n.lines.type.values).values
+    v_nom = n.buses.v_nom.reindex(n.lines.bus0.values).values
+    _lines_s_nom = pd.Series(np.sqrt(3) * i_nom * n.lines.num_parallel.values * v_nom,
+                             index=n.lines.index)
     lines_s_nom = n.lines.s_nom.where(n.lines.type == '', _lines_s_nom)
 
 
     col = 'capital_cost' if ll_type == 'c' else 'length'
-    ref = (lines_s_nom @ n.lines[col] +
-           n.links.loc[links_dc_b, "p_nom"] @ n.links.loc[links_dc_b, col])
-
-    update_transmission_costs(n, costs)
+    ref = (np.dot(lines_s_nom.values, n.lines[col].values) +
+           np.dot(n.links.loc[links_dc_b, "p_nom"].values,
+                  n.links.loc[links_dc_b, col].values))
 
     if factor == 'opt' or float(factor) > 1.0:
-        n.lines['s_nom_min'] = lines_s_nom
+        update_transmission_costs(n, costs)
+
+        n.lines['s_nom_min'] = lines_s_nom.values
         n.lines['s_nom_extendable'] = True
 
-        n.links.loc[links_dc_b, 'p_nom_min'] = n.links.loc[links_dc_b, 'p_nom']
-        n.links.loc[links_dc_b, 'p_nom_extendable'] = True
+        # resolve the DC mask to positions once for both columns
+        dc_i = np.flatnonzero(links_dc_b.values)
+        p_nom_min = n.links.p_nom_min.values.copy()
+        p_nom_min[dc_i] = n.links.p_nom.values[dc_i]
+        n.links['p_nom_min'] = p_nom_min
+        p_nom_extendable = n.links.p_nom_extendable.values.copy()
+        p_nom_extendable[dc_i] = True
+        n.links['p_nom_extendable'] = p_nom_extendable
 
     if factor != 'opt':
         con_type = 'expansion_cost' if ll_type == 'c' else 'volume_expansion'
@@ -123,21 +142,39 @@ def set_transmission_limit(n, ll_type, factor, costs, Nyears=1):
     return n
 
 
-def average_every_nhours(n, offset):
+def average_every_nhours(n, offset, nprocesses=1):
     logger.info(f"Resampling the network to {offset}")
-    m = n.copy(with_time=False)
 
     snapshot_weightings = n.snapshot_weightings.resample(offset).sum()
-    m.set_snapshots(snapshot_weightings.index)
-    m.snapshot_weightings = snapshot_weightings
 
-    for c in n.iterate_components():
-        pnl = getattr(m, c.list_name+"_t")
-        for k, df in c.pnl.items():
-            if not df.empty:
-                pnl[k] = df.resample(offset).mean()
+    # assign each snapshot to its resampling bin once and reuse the
+    # categorical codes for all time series instead of resampling each
+    bins = snapshot_weightings.index
+    grouper = pd.Categorical(bins[bins.searchsorted(n.snapshots, side='right') - 1],
+                             categories=bins)
+
+    def resample(df):
+        return df.groupby(grouper, observed=False).mean().set_axis(bins)
+
+    # resample in place rather than copying all static data; the original
+    # time series are collected and replaced by empty frames, so that
+    # set_snapshots() only has to reindex empty frames
+    tasks = [(c.pnl, k, df)
+             for c in n.iterate_components()
+             for k, df in c.pnl.items() if not df.empty]
+    for pnl, k, df in tasks:
+        pnl[k] = df.iloc[:, :0]
+
+    n.set_snapshots(bins)
+    n.snapshot_weightings = snapshot_weightings
+
+    # time series are independent of each other, average them concurrently
+    with ThreadPoolExecutor(max_workers=nprocesses) as executor:
+        resampled = executor.map(resample, [df for _, _, df in tasks])
+        for (pnl, k, _), df in zip(tasks, resampled):
+            pnl[k] = df
 
-    return m
+    return n
 
 
 def apply_time_segmentation(n, segments, solver_name="cbc"):
@@ -181,23 +218,68 @@ def apply_time_segmentation(n, segments, solver_name="cbc"):
 
 def enforce_autarky(n, only_crossborder=False):
     if only_crossborder:
-        lines_rm = n.lines.loc[
-                        n.lines.bus0.map(n.buses.country) !=
-                        n.lines.bus1.map(n.buses.country)
-                    ].index
-        links_rm = n.links.loc[
-                        n.links.bus0.map(n.buses.country) !=
-                        n.links.bus1.map(n.buses.country)
-                    ].index
+        countries = n.buses.country.values
+        def crossborder(df):
+            i0 = n.buses.index.get_indexer(df.bus0)
+            i1 = n.buses.index.get_indexer(df.bus1)
+            # branches attached to unknown buses (-1) count as cross-border
+            return (i0 == -1) | (i1 == -1) | (countries[i0] != countries[i1])
+        lines_rm = n.lines.index[crossborder(n.lines)]
+        links_rm = n.links.index[crossborder(n.links)]
     else:
         lines_rm = n.lines.index
-        links_rm = n.links.loc[n.links.carrier=="DC"].index
-    n.mremove("Line", lines_rm)
-    n.mremove("Link", links_rm)
+        links_rm = n.links.index[(n.links.carrier == "DC").values]
+    if len(lines_rm): n.mremove("Line", lines_rm)
+    if len(links_rm): n.mremove("Link", links_rm)
 
 def set_line_nom_max(n, s_nom_max_set=np.inf, p_nom_max_set=np.inf):
-    n.lines.s_nom_max.clip(upper=s_nom_max_set, inplace=True)
-    n.links.p_nom_max.clip(upper=p_nom_max_set, inplace=True)
+    if np.isfinite(s_nom_max_set):
+        n.lines['s_nom_max'] = np.minimum(n.lines.s_nom_max.values, s_nom_max_set)
+    if np.isfinite(p_nom_max_set):
+        n.links['p_nom_max'] = np.minimum(n.links.p_nom_max.values, p_nom_max_set)
+
+def export_time_series_to_parquet(n, path, row_group_size=8760):
+    # one file per component attribute, e.g. generators_t-p_max_pu.parquet;
+    # row groups carry min/max statistics so that readers can filter by snapshot
+    os.makedirs(path, exist_ok=True)
+    for c in n.iterate_components():
+        for k, df in c.pnl.items():
+            if df.empty: continue
+            (df.rename_axis(index='snapshot', columns=c.name)
+             .to_parquet(os.path.join(path, f"{c.list_name}_t-{k}.parquet"),
+                         compression='zstd', row_group_size=row_group_size))
+
+def export_to_netcdf_compressed(n, path, complevel=3):
+    # without a path PyPSA only returns the dataset, which is then written
+    # with zlib compression for all numeric variables
+    ds = n.export_to_netcdf()
+    encoding = {v: dict(zlib=True, complevel=complevel)
+                for v in ds.data_vars if ds[v].dtype.kind in 'biuf'}
+    ds.to_netcdf(path, encoding=encoding)
+
+def parse_opts(opts, suptechs):
+    """
+    Tokenize the ``opts`` wildcard in a single pass.
+
+    The first time resolution (``nhours``), segmentation (``segments``) and
+    CO2 limit (``co2limit``, relative factor or ``None``) option are kept, as
+    well as all carrier cost factors as tuples of ``(carrier, attr, factor)``.
+    """
+    parsed = {'cost_factors': []}
+    for o in opts:
+        if 'nhours' not in parsed and HOURS_RE.match(o):
+            parsed['nhours'] = o
+        if 'segments' not in parsed and SEGMENTS_RE.match(o):
+            parsed['segments'] = o[:-3]
+        if 'co2limit' not in parsed and "Co2L" in o:
+            m = FLOAT_RE.findall(o)
+            parsed['co2limit'] = float(m[0]) if len(m) > 0 else None
+        oo = o.split("+")
+        if oo[0].startswith(suptechs):
+            # handles only p_nom_max as stores and lines have no potentials
+            attr_lookup = {"p": "p_nom_max", "c": "capital_cost"}
+            parsed['cost_factors'].append((oo[0], attr_lookup[oo[1][0]], float(oo[1][1:])))
+    return parsed
 
 if __name__ == "__main__":
     if 'snakemake' not in globals():
@@ -210,62 +292,55 @@ if __name__ == "__main__":
 
     n = pypsa.Network(snakemake.input[0])
     Nyears = n.snapshot_weightings.objective.sum() / 8760.
-    costs = load_costs(snakemake.input.tech_costs, snakemake.config['costs'], snakemake.config['electricity'], Nyears)
 
     set_line_s_max_pu(n, snakemake.config['lines']['s_max_pu'])
 
-    for o in opts:
-        m = re.match(r'^\d+h$', o, re.IGNORECASE)
-        if m is not None:
-            n = average_every_nhours(n, m.group(0))
-            break
+    suptechs = tuple(c.split("-", 2)[0] for c in n.carriers.index)
+    parsed = parse_opts(opts, suptechs)
 
-    for o in opts:
-        m = re.match(r'^\d+seg$', o, re.IGNORECASE)
-        if m is not None:
-            solver_name = snakemake.config["solving"]["solver"]["name"]
-            n = apply_time_segmentation(n, m.group(0)[:-3], solver_name)
-            break
+    if 'nhours' in parsed:
+        n = average_every_nhours(n, parsed['nhours'], int(snakemake.threads))
 
-    for o in opts:
-        if "Co2L" in o:
-            m = re.findall("[0-9]*\.?[0-9]+$", o)
-            if len(m) > 0:
-                co2limit = float(m[0]) * snakemake.config['electricity']['co2base']
-                add_co2limit(n, co2limit, Nyears)
-            else:
-                add_co2limit(n, snakemake.config['electricity']['co2limit'], Nyears)
-            break
+    if 'segments' in parsed:
+        solver_name = snakemake.config["solving"]["solver"]["name"]
+        n = apply_time_segmentation(n, parsed['segments'], solver_name)
 
-    for o in opts:
-        oo = o.split("+")
-        suptechs = map(lambda c: c.split("-", 2)[0], n.carriers.index)
-        if oo[0].startswith(tuple(suptechs)):
-            carrier = oo[0]
-            # handles only p_nom_max as stores and lines have no potentials
-            attr_lookup = {"p": "p_nom_max", "c": "capital_cost"}
-            attr = attr_lookup[oo[1][0]]
-            factor = float(oo[1][1:])
-            if carrier == "AC":  # lines do not have carrier
-                n.lines[attr] *= factor
-            else:
-                comps = {"Generator", "Link", "StorageUnit", "Store"}
-                for c in n.iterate_components(comps):
-                    sel = c.df.carrier.str.contains(carrier)
-                    c.df.loc[sel,attr] *= factor
+    if 'co2limit' in parsed:
+        if parsed['co2limit'] is not None:
+            co2limit = parsed['co2limit'] * snakemake.config['electricity']['co2base']
+            add_co2limit(n, co2limit, Nyears)
+        else:
+            add_co2limit(n, snakemake.config['electricity']['co2limit'], Nyears)
+
+    for carrier, attr, factor in parsed['cost_factors']:
+        if carrier == "AC":  # lines do not have carrier
+            n.lines[attr] *= factor
+        else:
+            comps = {"Generator", "Link", "StorageUnit", "Store"}
+            for c in n.iterate_components(comps):
+                sel = c.df.carrier.str.startswith(carrier)
+                c.df.loc[sel,attr] *= factor
 
     if 'Ep' in opts:
         add_emission_prices(n, snakemake.config['costs']['emission_prices'])
 
     ll_type, factor = snakemake.wildcards.ll[0], snakemake.wildcards.ll[1:]
+    # costs are only needed if transmission capacities become extendable
+    if factor == 'opt' or float(factor) > 1.0:
+        costs = load_costs(snakemake.input.tech_costs, snakemake.config['costs'], snakemake.config['electricity'], Nyears)
+    else:
+        costs = None
     set_transmission_limit(n, ll_type, factor, costs, Nyears)
 
-    set_line_nom_max(n, s_nom_max_set=snakemake.config["lines"].get("s_nom_max,", np.inf),
-                     p_nom_max_set=snakemake.config["links"].get("p_nom_max,", np.inf))
+    set_line_nom_max(n, s_nom_max_set=snakemake.config["lines"].get("s_nom_max", np.inf),
+                     p_nom_max_set=snakemake.config["links"].get("p_nom_max", np.inf))
 
     if "ATK" in opts:
         enforce_autarky(n)
     elif "ATKc" in opts:
         enforce_autarky(n, only_crossborder=True)
 
-    n.export_to_netcdf(snakemake.output[0])
+    if 'parquet' in snakemake.output.keys():
+        export_time_series_to_parquet(n, snakemake.output.parquet)
+
+    export_to_netcdf_compressed(n, snakemake.output[0])